@@ -8,29 +8,165 @@ The JsonLogic class was adapted from https://github.com/nadirizr/json-logic-py
 __version__ = "0.9.4"
 
 
+import collections
+import contextlib
 import functools
 import json
+import math
 import mimetypes
 import os.path
 import re
 import sqlite3
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# The types of keys that can be stored in an index.
+_KEY_TYPES = (str, int, float)
 
 _INDEXNAME_RX = re.compile(r"[a-z][a-z0-9_]*", re.IGNORECASE)
+_KEYPATH_RX = re.compile(r"[a-z_][a-z0-9_]*(\.[a-z_][a-z0-9_]*)*", re.IGNORECASE)
+
+# SQL for the frequently executed statements. Defined once, so that the
+# identical string always hits the sqlite3 statement cache.
+_SQL_GET = "SELECT document FROM documents WHERE identifier=?"
+_SQL_EXISTS = "SELECT 1 FROM documents WHERE identifier=? LIMIT 1"
+_SQL_COUNT_DOCS = "SELECT COUNT(*) FROM documents"
+_SQL_ANY_DOCS = "SELECT 1 FROM documents LIMIT 1"
+_SQL_DATA_VERSION = "PRAGMA data_version"
+_SQL_INSERT = "INSERT INTO documents (identifier, document) VALUES (?, ?)"
+_SQL_UPDATE = "UPDATE documents SET document=? WHERE identifier=?"
+_SQL_UPSERT = "INSERT INTO documents (identifier, document) VALUES (?, ?) ON CONFLICT (identifier) DO UPDATE SET document=excluded.document"
+_SQL_DELETE_DOC = "DELETE FROM documents WHERE identifier=?"
+_SQL_DELETE_ATTS = "DELETE FROM attachments WHERE identifier=?"
+# The CAST bypasses the JSONDOC converter, or binds bytes as text.
+_SQL_GET_RAW = "SELECT CAST(document AS BLOB) FROM documents WHERE identifier=?"
+_SQL_INSERT_RAW = "INSERT INTO documents (identifier, document) VALUES (?, CAST(? AS TEXT))"
+_SQL_UPDATE_RAW = "UPDATE documents SET document=CAST(? AS TEXT) WHERE identifier=?"
+
+# Stored as 'PRAGMA user_version' in the header of a jsondocdb file: "jsdb".
+_USER_VERSION = 0x6A736462
+
+# The content type of an attachment, when it cannot be guessed from the name.
+_DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# The size of the chunks when streaming attachment content.
+_CHUNK_SIZE = 65536
+
+# Room for the statements of a fair number of indexes; sqlite3 default is 128.
+_CACHED_STATEMENTS = 256
+
+# The SQLite settings applied to each connection, unless overridden.
+_PRAGMAS = {
+    "journal_mode": "WAL",      # Readers do not block the writer, and vice versa.
+    "synchronous": "NORMAL",    # Safe with WAL; no fsync on each commit.
+    "temp_store": "MEMORY",
+    "cache_size": -65536,       # In KiB, i.e. 64 MiB.
+    "mmap_size": 268435456,     # 256 MiB.
+}
+# The SQLite settings within 'Database.bulk_load', unless overridden.
+_BULK_LOAD_PRAGMAS = {
+    "synchronous": "OFF",       # No syncing to disk at all.
+    "cache_size": -262144,      # In KiB, i.e. 256 MiB.
+}
+_PRAGMA_VALUE_RX = re.compile(r"-?[a-z0-9_]+", re.IGNORECASE)
+
+
+# Integers of 19 or more digits may lie outside the 64-bit range of orjson,
+# which would decode them to float.
+_LONG_DIGITS_RX = re.compile(r"\d{19}")
+_LONG_DIGITS_BYTES_RX = re.compile(rb"\d{19}")
+
+
+def _jsondoc_loads(data, strict=False):
+    """Decode JSON text given as str or UTF-8 bytes. Uses orjson if available,
+    except for text that it does not handle, such as very large integers,
+    or NaN and Infinity. If 'strict', NaN and Infinity are not accepted,
+    since they are not valid JSON to SQLite.
+    """
+    parse_constant = _reject_constant if strict else None
+    if orjson is None:
+        return json.loads(data, parse_constant=parse_constant)
+    if isinstance(data, str):
+        if _LONG_DIGITS_RX.search(data):
+            return json.loads(data, parse_constant=parse_constant)
+    elif _LONG_DIGITS_BYTES_RX.search(data):
+        return json.loads(data, parse_constant=parse_constant)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data, parse_constant=parse_constant)
+
+
+def _reject_constant(name):
+    "For 'json.loads': reject NaN, Infinity and -Infinity."
+    raise ValueError(f"Invalid JSON constant '{name}'.")
+
+
+def _jsondoc_dumps(jsondoc):
+    """Encode to JSON text as str. Uses orjson if available, except for
+    values that it does not handle, such as integers outside the 64-bit range.
+    NaN and Infinity are encoded as null, since they are not valid JSON.
+    """
+    if orjson is None:
+        return _json_dumps(jsondoc)
+    try:
+        # Kept as str, since the SQLite JSON1 functions require text.
+        return orjson.dumps(jsondoc, option=orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
+        return _json_dumps(jsondoc)
+
+
+def _json_dumps(jsondoc):
+    """Encode to JSON text as str using the json module. NaN and Infinity
+    are encoded as null, as by orjson, so that SQLite can parse the text.
+    """
+    try:
+        return json.dumps(jsondoc, ensure_ascii=False, allow_nan=False)
+    except ValueError:
+        return json.dumps(_finite(jsondoc), ensure_ascii=False, allow_nan=False)
+
+
+def _finite(value):
+    "Return a copy of the JSON value with NaN and Infinity replaced by None."
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    elif isinstance(value, dict):
+        return dict((key, _finite(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    else:
+        return value
+
+
+def _check_pragmas(settings):
+    """Check the names and values of the given SQLite settings, since they
+    cannot be given as parameters. A value of None is allowed.
+
+    Raises ValueError if a setting name or value is invalid.
+    """
+    for name, value in settings.items():
+        if not _INDEXNAME_RX.fullmatch(name):
+            raise ValueError(f"Invalid pragma '{name}'.")
+        if value is not None and not _PRAGMA_VALUE_RX.fullmatch(str(value)):
+            raise ValueError(f"Invalid pragma '{name}={value}'.")
 
 
 def _jsondoc_converter(data):
     if data is None:
         return None
     else:
-        return json.loads(data)
+        return _jsondoc_loads(data)
 
 
 def _jsondoc_adapter(jsondoc):
     if jsondoc is None:
         return None
     else:
-        return json.dumps(jsondoc, ensure_ascii=False)
+        return _jsondoc_dumps(jsondoc)
 
 
 sqlite3.register_converter("JSONDOC", _jsondoc_converter)
@@ -40,7 +176,7 @@ sqlite3.register_adapter(dict, _jsondoc_adapter)
 class Database:
     "A Python Sqlite3 database for JSON documents. Simple indexing using JsonLogic."
 
-    def __init__(self, filepath=None, readonly=False, **kwargs):
+    def __init__(self, filepath=None, readonly=False, pragmas=None, **kwargs):
         """If a filepath is given, open or create the database file.
 
         If the file exists, checks that it has the tables required for jsondocdb.
@@ -51,22 +187,32 @@ class Database:
         sqlite3.connect, except for 'detect_types', which is hard-wired
         to sqlite3.PARSE_DECLTYPES, and 'isolation_level' which is set to None,
         i.e. explicit transactions.
+
+        'pragmas' is an optional dictionary of SQLite PRAGMA settings, which
+        override the defaults: WAL journal mode, NORMAL synchronous, and
+        larger cache and memory map. A value of None skips that setting.
         """
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
+        self._len = None
         if filepath:
             if os.path.exists(filepath):
-                self.open(filepath, readonly=readonly, **kwargs)
+                self.open(filepath, readonly=readonly, pragmas=pragmas, **kwargs)
             elif readonly:
                 raise OSError("Cannot create database file for 'readonly' mode.")
             else:
-                self.create(filepath, **kwargs)
+                self.create(filepath, pragmas=pragmas, **kwargs)
 
-    def create(self, filepath, **kwargs):
+    def create(self, filepath, pragmas=None, **kwargs):
         """Create the database file and initialize it with the required tables.
 
         The 'filepath' and any additional keyword arguments are passed  to
         sqlite3.connect, except for 'detect_types', which is hard-wired
         to sqlite3.PARSE_DECLTYPES, and 'isolation_level' which is set to None,
-        i.e. explicit transactions.
+        i.e. explicit transactions. 'cached_statements' defaults to 256.
+
+        'pragmas' is an optional dictionary of SQLite PRAGMA settings;
+        see '__init__'.
 
         Creates the required tables.
         """
@@ -78,11 +224,13 @@ class Database:
         self.filepath = filepath
         kwargs["detect_types"] = sqlite3.PARSE_DECLTYPES  # For JSONDOC handling.
         kwargs["isolation_level"] = None                  # Use explicit transactions.
+        kwargs.setdefault("cached_statements", _CACHED_STATEMENTS)
 
         try:
             self.cnx = sqlite3.connect(self.filepath, **kwargs)
         except sqlite3.DatabaseError as error:
             raise InvalidFileError(str(error))
+        self._set_pragmas(pragmas)
         cursor = self.cnx.cursor()
         cursor.execute(
             "CREATE TABLE documents"
@@ -102,21 +250,31 @@ class Database:
             " content_type TEXT NOT NULL,"
             " content BLOB NOT NULL)"
         )
+        # The leftmost column 'identifier' also makes this index serve
+        # the lookups and deletes of all attachments for a document.
         cursor.execute(
             "CREATE UNIQUE INDEX attachments_index ON attachments (identifier, name)"
         )
+        cursor.execute(f"PRAGMA user_version = {_USER_VERSION}")
+        self._indexes = {}
+        self._data_version = self.cnx.execute(_SQL_DATA_VERSION).fetchone()[0]
 
-    def open(self, filepath, readonly=False, **kwargs):
+    def open(self, filepath, readonly=False, pragmas=None, **kwargs):
         """Open the existing database file.
 
-        Checks that it has the tables appropriate for jsondocdb.
+        Checks that it is a jsondocdb file by its user version or,
+        for older files, that it has the tables appropriate for jsondocdb.
 
         The 'filepath' and any additional keyword arguments are passed  to
         sqlite3.connect, except for:
         - 'detect_types', which is hard-wired to sqlite3.PARSE_DECLTYPES
         - 'isolation_level' which is set to None, i.e. explicit transactions.
+        'cached_statements' defaults to 256.
 
         'readonly' is a flag that thinly wraps the SQLite3 way of doing read-only.
+
+        'pragmas' is an optional dictionary of SQLite PRAGMA settings;
+        see '__init__'. The journal mode is not changed in 'readonly' mode.
         """
         if hasattr(self, 'cnx'):
             raise ConnectionError("There is already an open connection.")
@@ -126,21 +284,72 @@ class Database:
         self.filepath = filepath
         kwargs["detect_types"] = sqlite3.PARSE_DECLTYPES  # For JSONDOC handling.
         kwargs["isolation_level"] = None                  # Use explicit transactions.
+        kwargs.setdefault("cached_statements", _CACHED_STATEMENTS)
         if readonly:
             filepath = f"file:{self.filepath}?mode=ro"
             kwargs["uri"] = True
 
         try:
             self.cnx = sqlite3.connect(filepath, **kwargs)
-            cursor = self.cnx.cursor()
-            cursor = cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            names = [n[0] for n in cursor.fetchall()]
+            # The user version is read from the file header.
+            user_version = self.cnx.execute("PRAGMA user_version").fetchone()[0]
+            if user_version == 0:
+                # Files created before the user version was set.
+                cursor = self.cnx.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                names = [n[0] for n in cursor.fetchall()]
         except sqlite3.DatabaseError as error:
             raise InvalidFileError(str(error))
-        else:
+        if user_version == 0:
             if set(["documents", "indexes", "attachments"]).difference(names):
                 raise InvalidFileError("Database does not contain the required tables.")
+        elif user_version != _USER_VERSION:
+            raise InvalidFileError("Database is not a jsondocdb file.")
+        self._set_pragmas(pragmas, readonly=readonly)
+        self._load_indexes()
 
+    def _set_pragmas(self, pragmas=None, readonly=False):
+        """Apply the default SQLite settings, overridden by those given.
+
+        Raises ValueError if a setting name or value is invalid.
+        """
+        settings = dict(_PRAGMAS)
+        settings.update(pragmas or {})
+        # WAL does not apply to in-memory databases, and
+        # a read-only connection cannot change the journal mode.
+        if readonly or self.filepath in ("", ":memory:"):
+            settings.pop("journal_mode")
+        self._apply_pragmas(settings)
+
+    def _apply_pragmas(self, settings):
+        """Apply the given SQLite settings. A value of None skips that setting.
+        All settings are checked before any of them is applied.
+
+        Raises ValueError if a setting name or value is invalid.
+        """
+        _check_pragmas(settings)
+        for name, value in settings.items():
+            if value is not None:
+                self.cnx.execute(f"PRAGMA {name}={value}")
+
+    def _load_indexes(self):
+        """Load the definitions of all indexes in the database.
+        They are kept in memory, keyed by name, since they are
+        needed for every document that is added, updated or deleted.
+        """
+        self._data_version = self.cnx.execute(_SQL_DATA_VERSION).fetchone()[0]
+        cursor = self.cnx.execute("SELECT name FROM indexes")
+        self._indexes = dict((row[0], Index(self, row[0])) for row in cursor.fetchall())
+
+    def _refresh(self):
+        """Drop or reload what is kept in memory about the database, if
+        another connection has committed changes to it since last checked,
+        as shown by the data version. This is much cheaper than a query
+        of any table.
+        """
+        if self.cnx.execute(_SQL_DATA_VERSION).fetchone()[0] != self._data_version:
+            self._len = None
+            self._cache.clear()
+            self._load_indexes()
 
     def close(self):
         "Close the connection to the database."
@@ -149,6 +358,7 @@ class Database:
 
         self.cnx.close()
         del self.cnx
+        self._len = None
 
     @property
     def info(self):
@@ -164,24 +374,42 @@ class Database:
 
     def __str__(self):
         "Return a string with info about the database."
-        return f'jsondocdb.Database("{self.filepath}"): {len(self)} documents, {self.info["n_indexes"]} indexes, {self.info["n_attachments"]} attachments.'
+        info = self.info
+        return f'jsondocdb.Database("{self.filepath}"): {info["n_documents"]} documents, {info["n_indexes"]} indexes, {info["n_attachments"]} attachments.'
 
     def __iter__(self):
         """Return an iterator (generator, actually) over document identifiers
-        in the database.
+        in the database, in sorted order.
+
+        The order is that of the primary key index, which SQLite scans
+        for this and for 'values' and 'items'; no sorting is performed.
         """
-        return (row[0] for row in self.cnx.execute("SELECT identifier FROM documents"))
+        sql = "SELECT identifier FROM documents ORDER BY identifier"
+        return (row[0] for row in self.cnx.execute(sql))
 
     def __len__(self):
-        "Return the number of documents in the database."
-        return self.cnx.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        """Return the number of documents in the database.
+
+        The count is kept up to date by the writes on this connection.
+        It is recounted only when another connection has committed changes;
+        see '_refresh'.
+        """
+        self._refresh()
+        if self._len is None:
+            self._len = self.cnx.execute(_SQL_COUNT_DOCS).fetchone()[0]
+        return self._len
+
+    def __bool__(self):
+        "Are there any documents in the database? Does not count them."
+        if self._len is not None:
+            return bool(len(self))
+        return self.cnx.execute(_SQL_ANY_DOCS).fetchone() is not None
 
     def __contains__(self, identifier):
         "Return `True` if the given identifier is in the database, else `False`."
-        sql = "SELECT COUNT(*) FROM documents WHERE identifier=?"
         try:
-            return bool(self.cnx.execute(sql, (identifier,)).fetchone()[0])
-        except sqlite3.InterfaceError: # When bad identifier.
+            return self.cnx.execute(_SQL_EXISTS, (identifier,)).fetchone() is not None
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError): # When bad identifier.
             return False
 
     def __getitem__(self, identifier):
@@ -193,10 +421,23 @@ class Database:
         if not isinstance(identifier, str):
             raise TypeError("'identifier' must be an instance of 'str'.")
 
-        sql = "SELECT document FROM documents WHERE identifier=?"
-        row = self.cnx.execute(sql, (identifier,)).fetchone()
+        if self._cache_size:
+            self._refresh()  # Cached documents may have been changed elsewhere.
+            try:
+                document = self._cache[identifier]
+            except KeyError:
+                pass
+            else:
+                self._cache.move_to_end(identifier)
+                return document
+
+        row = self.cnx.execute(_SQL_GET, (identifier,)).fetchone()
         if not row:
             raise NoSuchDocumentError(f"No document '{identifier}'.")
+        if self._cache_size:
+            self._cache[identifier] = row[0]
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
         return row[0]
 
     def __setitem__(self, identifier, document):
@@ -211,19 +452,21 @@ class Database:
         if not isinstance(document, dict):
             raise TypeError("'document' must be an instance of 'dict'.")
 
+        self._cache.pop(identifier, None)
         cursor = self.cnx.cursor()
         try:
-            cursor.execute(
-                "INSERT INTO documents (identifier, document) VALUES (?, ?)",
-                (identifier, document),
-            )
+            cursor.execute(_SQL_INSERT, (identifier, document))
         except sqlite3.IntegrityError:
-            cursor.execute(
-                "UPDATE documents SET document=? where identifier=?",
-                (document, identifier),
-            )
-        for index in self.indexes():
-            index._put(identifier, document)
+            cursor.execute(_SQL_UPDATE, (document, identifier))
+            # Only an updated document may have previous index entries.
+            for index in self._indexes.values():
+                index._remove(identifier)
+        else:
+            if self._len is not None:
+                self._len += 1
+        # The transaction has been checked above, so not via 'Index._put'.
+        for index in self._indexes.values():
+            index._add(identifier, document)
 
     def __delitem__(self, identifier):
         """Delete the document with the given identifier from the database.
@@ -234,13 +477,16 @@ class Database:
         if not self.in_transaction:
             raise NotInTransactionError
 
+        self._cache.pop(identifier, None)
         cursor = self.cnx.cursor()
-        cursor.execute("DELETE FROM documents WHERE identifier=?", (identifier,))
+        cursor.execute(_SQL_DELETE_DOC, (identifier,))
         if cursor.rowcount != 1:
             raise NoSuchDocumentError(f"No document '{identifier}'.")
-        for index in self.indexes():
+        if self._len is not None:
+            self._len -= 1
+        for index in self._indexes.values():
             index._remove(identifier)
-        cursor.execute("DELETE FROM attachments WHERE identifier=?", (identifier,))
+        cursor.execute(_SQL_DELETE_ATTS, (identifier,))
 
     def __enter__(self):
         """A context manager for a transaction. All operations that modify
@@ -248,11 +494,19 @@ class Database:
         If all goes well, the transaction is committed.
         If an error occurs within the context block, the transaction is rolled back.
 
+        The write lock is acquired at the start, waiting for any other
+        connection to finish its transaction. The indexes are then reloaded
+        if another connection has changed the database, so that the writes
+        in the transaction update the current set of indexes. A deferred
+        transaction would instead fix its read snapshot at that check, and
+        a later write would fail if another connection committed meanwhile.
+
         Raises InTransactionError
         """
         if self.in_transaction:
             raise InTransactionError
-        self.cnx.execute("BEGIN")
+        self.cnx.execute("BEGIN IMMEDIATE")
+        self._refresh()
 
     def __exit__(self, type, value, tb):
         "End the transaction; commit if OK, rollback if not."
@@ -260,8 +514,58 @@ class Database:
             self.cnx.execute("COMMIT")
         else:
             self.cnx.execute("ROLLBACK")
+            self._cache.clear()
+            self._len = None
         return False
 
+    @contextlib.contextmanager
+    def bulk_load(self, pragmas=None):
+        """A context manager for loading many documents, in one or
+        more transactions within it. The SQLite settings favour speed
+        over durability: no syncing to disk, and a larger page cache.
+        The previous settings are restored on exit.
+
+        'pragmas' is an optional dictionary of SQLite PRAGMA settings,
+        which override those defaults. A setting that cannot be queried,
+        such as 'optimize', is applied on entry but not restored.
+
+        NOTE: With WAL and synchronous OFF, the most recent commits may be
+        lost if the operating system crashes or the power fails during
+        the load. A crash of the application itself loses nothing.
+
+        Raises InTransactionError
+        Raises ValueError if a setting name or value is invalid.
+        """
+        if self.in_transaction:
+            raise InTransactionError
+        settings = dict(_BULK_LOAD_PRAGMAS)
+        settings.update(pragmas or {})
+        _check_pragmas(settings)
+        previous = {}
+        for name in settings:
+            row = self.cnx.execute(f"PRAGMA {name}").fetchone()
+            if row is not None:
+                previous[name] = row[0]
+        try:
+            self._apply_pragmas(settings)
+            yield self
+        finally:
+            self._apply_pragmas(previous)
+
+    def set_cache_size(self, size):
+        """Set the maximum number of documents in the cache of recently
+        fetched documents. The default is 0, i.e. no caching.
+
+        NOTE: A cached document is returned as the same dict instance on
+        each fetch; it must not be modified unless it is put back.
+
+        The cache is cleared when another connection has committed changes
+        to the database, as shown by the data version; see '_refresh'.
+        """
+        self._cache_size = max(0, int(size))
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
     @property
     def in_transaction(self):
         "Are we within a transaction?"
@@ -272,7 +576,7 @@ class Database:
         If not found, return the 'default'.
         """
         try:
-            return self[id]
+            return self[identifier]
         except NoSuchDocumentError:
             return default
 
@@ -284,18 +588,64 @@ class Database:
         """
         self[identifier] = document
 
+    def get_raw(self, identifier):
+        """Return the document with the given identifier as its JSON text
+        in UTF-8 bytes, without decoding it.
+
+        Raises NoSuchDocumentError
+        """
+        row = self.cnx.execute(_SQL_GET_RAW, (identifier,)).fetchone()
+        if not row:
+            raise NoSuchDocumentError(f"No document '{identifier}'.")
+        return row[0]
+
+    def put_raw(self, identifier, data):
+        """Add or update the document given as its JSON text, either
+        str or UTF-8 bytes, without encoding it. The JSON is validated
+        by decoding it, so that it can be read back. If there are any
+        indexes, the decoded document is needed for them anyway, so then
+        this is the same as 'put'.
+
+        Raises NotInTransactionError
+        Raises TypeError if the data is not str or bytes.
+        Raises ValueError if the data is not a JSON object.
+        """
+        if not self.in_transaction:
+            raise NotInTransactionError
+        if not isinstance(data, (str, bytes)):
+            raise TypeError("'data' must be an instance of 'str' or 'bytes'.")
+        # The decoding errors of json and orjson are ValueError subclasses.
+        document = _jsondoc_loads(data, strict=True)
+        if not isinstance(document, dict):
+            raise ValueError("'data' must be a JSON object.")
+        if self._indexes:
+            self[identifier] = document
+            return
+
+        self._cache.pop(identifier, None)
+        cursor = self.cnx.cursor()
+        try:
+            cursor.execute(_SQL_INSERT_RAW, (identifier, data))
+        except sqlite3.IntegrityError:
+            cursor.execute(_SQL_UPDATE_RAW, (data, identifier))
+        else:
+            if self._len is not None:
+                self._len += 1
+
     def keys(self):
         "Return an iterator over the identifiers for all documents in the database."
         return iter(self)
 
     def values(self):
-        "Return a generator producing all documents in the database."
+        """Return a generator producing all documents in the database,
+        ordered by identifier.
+        """
         sql = "SELECT document FROM documents ORDER BY identifier"
         return (row[0] for row in self.cnx.execute(sql))
 
     def items(self):
         """Return a generator producing all tuples (identifier, document)
-        in the database.
+        in the database, ordered by identifier.
         """
         sql = "SELECT identifier, document FROM documents ORDER BY identifier"
         return (tuple(row) for row in self.cnx.execute(sql))
@@ -308,6 +658,69 @@ class Database:
         """
         del self[identifier]
 
+    def update_many(self, items):
+        """Add or update the documents in the database given as a dict,
+        or an iterable of (identifier, document) pairs. For duplicate
+        identifiers the last document is used.
+        Each table is handled by a single executemany call.
+
+        Raises NotInTransactionError
+        Raises TypeError if a document is of invalid type.
+        Raises ValueError if a key value is not a simple type, or list of simple types.
+        Raises NotUniqueError
+        """
+        if not self.in_transaction:
+            raise NotInTransactionError
+
+        documents = dict(items)
+        for identifier, document in documents.items():
+            if not isinstance(document, dict):
+                raise TypeError("'document' must be an instance of 'dict'.")
+            self._cache.pop(identifier, None)
+        cursor = self.cnx.cursor()
+        cursor.executemany(_SQL_UPSERT, documents.items())
+        self._len = None  # The number of new documents is not known.
+        rows = [(identifier,) for identifier in documents]
+        for index in self._indexes.values():
+            cursor.executemany(index._sql_delete, rows)
+            entries = ((identifier, key)
+                       for identifier, document in documents.items()
+                       for key in index._keys(identifier, document))
+            try:
+                cursor.executemany(index._sql_insert, entries)
+            except sqlite3.IntegrityError:
+                raise NotUniqueError(
+                    f"Index {index.name}, keypath {index.keypath}: keys are not unique."
+                )
+
+    def delete_many(self, identifiers):
+        """Delete the documents with the given identifiers from the database.
+        Each table is handled by a single executemany call.
+
+        All existing documents among those given are deleted, with their
+        index entries and attachments, before any error is raised.
+
+        Raises NotInTransactionError
+        Raises NoSuchDocumentError if any of the documents did not exist.
+        """
+        if not self.in_transaction:
+            raise NotInTransactionError
+
+        # An identifier given more than once is deleted once.
+        rows = [(identifier,) for identifier in dict.fromkeys(identifiers)]
+        for row in rows:
+            self._cache.pop(row[0], None)
+        cursor = self.cnx.cursor()
+        cursor.executemany(_SQL_DELETE_DOC, rows)
+        count = cursor.rowcount
+        if self._len is not None:
+            self._len -= count
+        for index in self._indexes.values():
+            cursor.executemany(index._sql_delete, rows)
+        cursor.executemany(_SQL_DELETE_ATTS, rows)
+        if count != len(rows):
+            raise NoSuchDocumentError(f"{len(rows) - count} of the documents did not exist.")
+
     def index(self, name, keypath=None, unique=False, require=None):
         """Return the index with the given name, or create it.
 
@@ -327,13 +740,18 @@ class Database:
         Raises IndexSpecificationError
         Raises IndexExistsError
         """
-        return Index(self, name, keypath=keypath, unique=unique, require=require)
+        if keypath is None:
+            try:
+                return self._indexes[name]
+            except KeyError:
+                pass
+        index = Index(self, name, keypath=keypath, unique=unique, require=require)
+        self._indexes[name] = index
+        return index
 
     def indexes(self):
         "Return a list of all current indexes."
-        cursor = self.cnx.cursor()
-        cursor.execute("SELECT name FROM indexes")
-        return [Index(self, row[0]) for row in cursor]
+        return list(self._indexes.values())
 
     def attachments(self, identifier):
         """Return the attachments interface for the given identifier.
@@ -342,16 +760,54 @@ class Database:
         """
         return Attachments(self, identifier)
 
+    def find(self, expression):
+        """Return a generator producing all tuples (identifier, document)
+        for the documents satisfying the given JsonLogic expression.
+
+        As far as possible, the expression is evaluated by SQLite, so that
+        documents that do not match need not be loaded into Python.
+        If SQLite cannot parse the text of a document, such as NaN written
+        by earlier versions of this module, the remaining documents are
+        evaluated in Python.
+        """
+        logic = JsonLogic(expression)
+        translated = logic.to_sql("document")
+        sql = "SELECT rowid, identifier, document FROM documents"
+        if translated is None:
+            params = []
+            exact = False
+        else:
+            where, params, exact = translated
+            sql += f" WHERE {where}"
+        return self._find(logic, f"{sql} ORDER BY rowid", params, exact)
+
+    def _find(self, logic, sql, params, exact):
+        "Produce the tuples for 'find'; see there."
+        last = 0
+        try:
+            for rowid, identifier, document in self.cnx.execute(sql, params):
+                last = rowid
+                if exact or logic.apply(document):
+                    yield (identifier, document)
+        except sqlite3.OperationalError:
+            sql = "SELECT identifier, document FROM documents WHERE rowid>? ORDER BY rowid"
+            for identifier, document in self.cnx.execute(sql, (last,)):
+                if logic.apply(document):
+                    yield (identifier, document)
+
 
 class Index:
     "Interface to the named index in the database."
 
     def __init__(self, db, name, keypath=None, unique=False, require=None):
         "New or existing index."
-        if not _INDEXNAME_RX.match(name):
+        if not isinstance(name, str) or not _INDEXNAME_RX.fullmatch(name):
             raise IndexSpecificationError(f"Invalid index name '{name}'.")
         self.db = db
         self.name = name
+        # Formatted once here, since used for every document added or deleted.
+        self._sql_insert = f"INSERT INTO i_{name} (identifier, key) VALUES (?, ?)"
+        self._sql_delete = f"DELETE FROM i_{name} WHERE identifier=?"
         if keypath:
             self._create(keypath, unique, require)
         else:
@@ -404,7 +860,10 @@ class Index:
         self.unique = bool(unique)
         self.require = require
         self.keypathlogic = JsonLogic({"var": keypath})
-        self.requirelogic = JsonLogic(require)
+        try:
+            self.requirelogic = JsonLogic(require)
+        except ValueError as error:
+            raise IndexSpecificationError(f"Invalid index 'require'; {error}")
 
         with self.db:
             try:  # 'uniq' since 'unique' is a reserved word.
@@ -422,13 +881,60 @@ class Index:
             self.db.cnx.execute(sql)
 
             # Add all existing documents in the database into this index.
+            # The transaction is rolled back on error.
             try:
-                sql = "SELECT identifier, document FROM documents"
-                for identifier, document in self.db.cnx.execute(sql).fetchall():
-                    self._add(identifier, document)
+                path = JsonLogic._sql_path(self.keypathlogic.expression)
+                if self.require or path is None:
+                    self._fill()
+                else:
+                    try:
+                        self._fill_sql(path)
+                    except sqlite3.OperationalError:
+                        # Some document text is not valid to SQLite, such
+                        # as NaN written by earlier versions of this module.
+                        self._fill()
             except sqlite3.IntegrityError:
-                self.db.cnx.execute(f"DROP TABLE i_{self.name}")
-                raise NotUniqueError
+                raise NotUniqueError(
+                    f"Index {self.name}, keypath {self.keypath}: keys are not unique."
+                )
+        self.db._indexes[self.name] = self
+
+    def _fill(self):
+        """Add entries for all documents in the database to this index,
+        in one executemany call. The documents are streamed from a separate
+        cursor, so that only one at a time is held in memory.
+        """
+        sql = "SELECT identifier, document FROM documents"
+        rows = ((identifier, key)
+                for identifier, document in self.db.cnx.cursor().execute(sql)
+                for key in self._keys(identifier, document))
+        self.db.cnx.executemany(self._sql_insert, rows)
+
+    def _fill_sql(self, path):
+        """Add entries for all documents in the database to this index,
+        using the JSON path of a simple keypath. This is done entirely
+        within SQLite, without decoding the documents in Python.
+        The result is the same as for '_fill'.
+
+        Raises ValueError if a key value is not a simple type, or list of simple types.
+        """
+        sql = ("SELECT identifier, json_extract(document, ?1) FROM documents"
+               " WHERE json_type(document, ?1) = 'object'"
+               " OR (json_type(document, ?1) = 'array' AND EXISTS"
+               " (SELECT 1 FROM json_each(document, ?1)"
+               " WHERE type IN ('null', 'object', 'array')))"
+               " LIMIT 1")
+        row = self.db.cnx.execute(sql, (path,)).fetchone()
+        if row:
+            raise ValueError(
+                f"Document {row[0]}, keypath {self.keypath}, key {row[1]} is not a simple type, or list of simple types."
+            )
+        # A scalar value yields one row from json_each, a list one per element.
+        sql = (f"INSERT INTO i_{self.name} (identifier, key)"
+               " SELECT d.identifier, j.value"
+               " FROM documents AS d, json_each(d.document, ?) AS j"
+               " WHERE j.type <> 'null'")
+        self.db.cnx.execute(sql, (path,))
 
     def __len__(self):
         "Return the number of entries in the index."
@@ -437,10 +943,10 @@ class Index:
 
     def __contains__(self, key):
         "Is there at least one entry in the index for the given key?"
-        sql = f"SELECT COUNT(*) FROM i_{self.name} WHERE key=?"
+        sql = f"SELECT 1 FROM i_{self.name} WHERE key=? LIMIT 1"
         try:
-            return bool(self.db.cnx.execute(sql, (key,)).fetchone()[0])
-        except sqlite3.InterfaceError:
+            return self.db.cnx.execute(sql, (key,)).fetchone() is not None
+        except (sqlite3.InterfaceError, sqlite3.ProgrammingError): # When bad key.
             return False
     
     def delete(self):
@@ -454,6 +960,7 @@ class Index:
         with self.db:
             self.db.cnx.execute("DELETE FROM indexes WHERE name=?", (self.name,))
         self.db.cnx.execute(f"DROP TABLE i_{self.name}")
+        self.db._indexes.pop(self.name, None)
         self.keypath = None
         self.unique = False
         self.require = None
@@ -539,35 +1046,35 @@ class Index:
 
     def _remove(self, identifier):
         "Remove the entries for this identifier from the index."
-        self.db.cnx.execute(f"DELETE FROM i_{self.name} WHERE identifier=?", (identifier,))
+        self.db.cnx.execute(self._sql_delete, (identifier,))
+
+    def _keys(self, identifier, document):
+        """Return the list of keys for the identifier and document in this index.
+
+        Raises ValueError if a key value is not a simple type, or list of simple types.
+        """
+        # Most indexes have no 'require'; skip the call to it entirely.
+        if self.require and not self.requirelogic.apply(document):
+            return []
+        key = self.keypathlogic.apply(document)
+        if key is None:
+            return []
+        # The exact type test is cheaper, and is true for most keys.
+        if type(key) in _KEY_TYPES or isinstance(key, _KEY_TYPES):
+            return [key]
+        if isinstance(key, list) and all(isinstance(k, _KEY_TYPES) for k in key):
+            return key
+        raise ValueError(
+            f"Document {identifier}, keypath {self.keypath}, key {key} is not a simple type, or list of simple types."
+        )
 
     def _add(self, identifier, document):
         """Add entries for the identifier and document to this index.
         Previous entries are not removed.
         """
-        if not self.requirelogic.apply(document):
-            return
-        key = self.keypathlogic.apply(document)
-        if key is None:
-            return
-        try:
-            if isinstance(key, (str, int, float)):
-                keys = [key]
-            elif isinstance(key, list):
-                keys = key
-                for key in keys:
-                    if not isinstance(key, (str, int, float)):
-                        raise ValueError
-            else:
-                raise ValueError
-        except ValueError:
-            raise ValueError(
-                f"Document {identifier}, keypath {keypathlogic.expression.var}, key {key} is not a simple type, or list of simple types."
-            )
-        for key in keys:
+        for key in self._keys(identifier, document):
             try:
-                sql = f"INSERT INTO i_{self.name} (identifier, key) VALUES (?, ?)"
-                self.db.cnx.execute(sql, (identifier, key))
+                self.db.cnx.execute(self._sql_insert, (identifier, key))
             except sqlite3.IntegrityError:
                 raise NotUniqueError(
                     f"Document {identifier}, index {self.name}, keypath {self.keypath}, key {key} is not unique."
@@ -593,6 +1100,11 @@ class Attachments:
         sql = "SELECT COUNT(*) FROM attachments WHERE identifier=?"
         return self.db.cnx.execute(sql, (self.identifier,)).fetchone()[0]
 
+    def __bool__(self):
+        "Are there any attachments for this document? Does not count them."
+        sql = "SELECT 1 FROM attachments WHERE identifier=? LIMIT 1"
+        return self.db.cnx.execute(sql, (self.identifier,)).fetchone() is not None
+
     def __getitem__(self, name):
         return self.get(name)
 
@@ -620,7 +1132,8 @@ class Attachments:
     def put(self, name, content, content_type=None):
         """Add or update the given content as attachment to the document.
 
-        The content_type is guessed from the name, if not given explicitly.
+        The content_type is guessed from the name, if not given explicitly,
+        or else set to 'application/octet-stream'.
 
         Raises TypeError if name is not str, or the content is not bytes.
         Raises NotInTransactionError
@@ -633,7 +1146,7 @@ class Attachments:
             raise NotInTransactionError
 
         if content_type is None:
-            content_type = mimetypes.guess_type(name)[0]
+            content_type = mimetypes.guess_type(name)[0] or _DEFAULT_CONTENT_TYPE
         cursor = self.db.cnx.cursor()
         try:
             cursor.execute(
@@ -645,6 +1158,74 @@ class Attachments:
                 "UPDATE attachments SET content_type=?, content=? WHERE identifier=? AND name=?",
                 (content_type, content, self.identifier, name),
             )
+            if cursor.rowcount != 1:  # Not due to an existing attachment.
+                raise
+
+    def put_stream(self, name, infile, size, content_type=None):
+        """Add or update the content read from the binary file-like object
+        as attachment to the document. Exactly 'size' bytes are read.
+
+        The content is written in chunks into a blob of the given size,
+        so that the whole content is never held in memory. This requires
+        Python 3.11; otherwise the content is read in one go.
+
+        The content_type is guessed from the name, if not given explicitly,
+        or else set to 'application/octet-stream'.
+
+        Raises TypeError if name is not str.
+        Raises NotInTransactionError
+        Raises ValueError if the file-like object has less than 'size' bytes.
+        """
+        if not hasattr(self.db.cnx, "blobopen"):
+            content = infile.read(size)
+            if len(content) != size:
+                raise ValueError("Attachment content is shorter than the given size.")
+            self.put(name, content, content_type=content_type)
+            return
+        if not isinstance(name, str):
+            raise TypeError("Atachment name must be 'str'.")
+        if not self.db.in_transaction:
+            raise NotInTransactionError
+
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0] or _DEFAULT_CONTENT_TYPE
+        cursor = self.db.cnx.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO attachments (identifier, name, content_type, content) VALUES (?, ?, ?, zeroblob(?))",
+                (self.identifier, name, content_type, size),
+            )
+        except sqlite3.IntegrityError:
+            cursor.execute(
+                "UPDATE attachments SET content_type=?, content=zeroblob(?) WHERE identifier=? AND name=?",
+                (content_type, size, self.identifier, name),
+            )
+            if cursor.rowcount != 1:  # Not due to an existing attachment.
+                raise
+        sql = "SELECT rowid FROM attachments WHERE identifier=? AND name=?"
+        rowid = cursor.execute(sql, (self.identifier, name)).fetchone()[0]
+        with self.db.cnx.blobopen("attachments", "content", rowid) as blob:
+            remaining = size
+            while remaining > 0:
+                chunk = infile.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ValueError("Attachment content is shorter than the given size.")
+                blob.write(chunk)
+                remaining -= len(chunk)
+
+    def put_file(self, name, filepath, content_type=None):
+        """Add or update the content of the file as attachment to the document.
+        The content is streamed into the database; see 'put_stream'.
+
+        The content_type is guessed from the name, if not given explicitly,
+        or else set to 'application/octet-stream'.
+
+        Raises TypeError if name is not str.
+        Raises NotInTransactionError
+        """
+        with open(filepath, "rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            self.put_stream(name, infile, size, content_type=content_type)
 
     def keys(self):
         "Return an iterator over the names of all attachments for the identifier."
@@ -724,7 +1305,16 @@ class JsonLogic:
     """
 
     def __init__(self, expression):
+        """Compile the expression once into a tree of closures, which
+        is then called for each data item given to 'apply'.
+
+        Raises ValueError if the expression contains an unrecognized operation.
+        """
         self.expression = expression or {}
+        if self.expression:
+            self._function = self._compile(self.expression)
+        else:
+            self._function = None
 
     @staticmethod
     def if_(*args):
@@ -755,22 +1345,32 @@ class JsonLogic:
 
     @staticmethod
     def less(a, b, *args):
-        """Implements the '<' operator with JS-style type coercion."""
-        types = set([type(a), type(b)])
-        if float in types or int in types:
-            try:
-                a, b = float(a), float(b)
-            except TypeError:
-                # NaN
+        """Implements the '<' operator with JS-style type coercion.
+        Chained comparisons are evaluated pairwise in a single loop.
+        """
+        values = (a, b) + args
+        for a, b in zip(values, values[1:]):
+            types = set([type(a), type(b)])
+            if float in types or int in types:
+                try:
+                    a, b = float(a), float(b)
+                except (TypeError, ValueError):
+                    # NaN
+                    return False
+            if not a < b:
                 return False
-        return a < b and (not args or less(b, *args))
+        return True
 
     @staticmethod
     def less_or_equal(a, b, *args):
-        """Implements the '<=' operator with JS-style type coercion."""
-        return (less(a, b) or soft_equals(a, b)) and (
-            not args or less_or_equal(b, *args)
-        )
+        """Implements the '<=' operator with JS-style type coercion.
+        Chained comparisons are evaluated pairwise in a single loop.
+        """
+        values = (a, b) + args
+        for a, b in zip(values, values[1:]):
+            if not (JsonLogic.less(a, b) or JsonLogic.soft_equals(a, b)):
+                return False
+        return True
 
     @staticmethod
     def to_numeric(arg):
@@ -779,23 +1379,31 @@ class JsonLogic:
         This is important, because e.g. {"!==": [{"+": "0"}, 0.0]}
         """
         if isinstance(arg, str):
-            if "." in arg:
-                return float(arg)
-            else:
-                return int(arg)
+            return JsonLogic.str_to_numeric(arg)
         return arg
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def str_to_numeric(arg):
+        """Converts a string either to int or to float.
+        Memoized, since the strings are usually literals in the expression.
+        """
+        if "." in arg:
+            return float(arg)
+        else:
+            return int(arg)
+
     @staticmethod
     def plus(*args):
         """Sum converts either to ints or to floats."""
-        return sum(to_numeric(arg) for arg in args)
+        return sum(JsonLogic.to_numeric(arg) for arg in args)
 
     @staticmethod
     def minus(*args):
         """Also, converts either to ints or to floats."""
         if len(args) == 1:
-            return -to_numeric(args[0])
-        return to_numeric(args[0]) - to_numeric(args[1])
+            return -JsonLogic.to_numeric(args[0])
+        return JsonLogic.to_numeric(args[0]) - JsonLogic.to_numeric(args[1])
 
     @staticmethod
     def merge(*args):
@@ -817,11 +1425,52 @@ class JsonLogic:
                     data = data[key]
                 except TypeError:
                     data = data[int(key)]
-        except (KeyError, TypeError, ValueError):
+        except (KeyError, IndexError, TypeError, ValueError):
             return not_found
         else:
             return data
 
+    @staticmethod
+    def compile_var(var_name):
+        """Return a function getting the variable value from data dictionary.
+        The keypath is split, and the list indexes converted, only once.
+        """
+        keys = []
+        for key in str(var_name).split("."):
+            try:
+                keys.append((key, int(key)))
+            except ValueError:
+                keys.append((key, None))
+        keys = tuple(keys)
+
+        # The usual case of a single, non-numeric key, like an index keypath.
+        if len(keys) == 1 and keys[0][1] is None:
+            key = keys[0][0]
+
+            def get_key(data):
+                try:
+                    return data[key]
+                except (KeyError, IndexError, TypeError):
+                    return None
+
+            return get_key
+
+        def get_var(data):
+            try:
+                for key, index in keys:
+                    try:
+                        data = data[key]
+                    except TypeError:
+                        if index is None:
+                            return None
+                        data = data[index]
+            except (KeyError, IndexError, TypeError):
+                return None
+            else:
+                return data
+
+        return get_var
+
     @staticmethod
     def missing(data, *args):
         """Implements the missing operator for finding missing variables."""
@@ -830,7 +1479,7 @@ class JsonLogic:
             args = args[0]
         ret = []
         for arg in args:
-            if get_var(data, arg, not_found) is not_found:
+            if JsonLogic.get_var(data, arg, not_found) is not_found:
                 ret.append(arg)
         return ret
 
@@ -843,7 +1492,7 @@ class JsonLogic:
         not_found = object()
         ret = []
         for arg in args:
-            if get_var(data, arg, not_found) is not_found:
+            if JsonLogic.get_var(data, arg, not_found) is not_found:
                 ret.append(arg)
             else:
                 found += 1
@@ -851,79 +1500,311 @@ class JsonLogic:
                     return []
         return ret
 
+    @staticmethod
+    def not_soft_equals(a, b):
+        """Implements the '!=' operator."""
+        return not JsonLogic.soft_equals(a, b)
+
+    @staticmethod
+    def not_hard_equals(a, b):
+        """Implements the '!==' operator."""
+        return not JsonLogic.hard_equals(a, b)
+
+    @staticmethod
+    def greater(a, b):
+        """Implements the '>' operator with JS-style type coercion."""
+        return JsonLogic.less(b, a)
+
+    @staticmethod
+    def greater_or_equal(a, b):
+        """Implements the '>=' operator with JS-style type coercion."""
+        return JsonLogic.less(b, a) or JsonLogic.soft_equals(a, b)
+
+    @staticmethod
+    def not_(a):
+        """Implements the '!' operator."""
+        return not a
+
+    @staticmethod
+    def modulo(a, b):
+        """Implements the '%' operator."""
+        return a % b
+
+    @staticmethod
+    def and_(*args):
+        """Implements the 'and' operator; the first falsy value, or the last."""
+        return next((arg for arg in args if not arg), args[-1] if args else True)
+
+    @staticmethod
+    def or_(*args):
+        """Implements the 'or' operator; the first truthy value, or the last."""
+        return next((arg for arg in args if arg), args[-1] if args else False)
+
+    @staticmethod
+    def ternary(a, b, c):
+        """Implements the '?:' operator."""
+        return b if a else c
+
+    @staticmethod
+    def in_(a, b):
+        """Implements the 'in' operator for substrings and list membership."""
+        return a in b if hasattr(b, "__contains__") else False
+
+    @staticmethod
+    def cat(*args):
+        """Implements the 'cat' operator for concatenating strings."""
+        return "".join(str(arg) for arg in args)
+
+    @staticmethod
+    def times(*args):
+        """Implements the '*' operator; converts to floats."""
+        return math.prod(float(arg) for arg in args)
+
+    @staticmethod
+    def divide(a, b=None):
+        """Implements the '/' operator; converts to floats."""
+        return a if b is None else float(a) / float(b)
+
+    @staticmethod
+    def min_(*args):
+        """Implements the 'min' operator."""
+        return min(args)
+
+    @staticmethod
+    def max_(*args):
+        """Implements the 'max' operator."""
+        return max(args)
+
+    @staticmethod
+    def count(*args):
+        """Implements the 'count' operator for the number of truthy values."""
+        return sum(1 for a in args if a)
+
     operations = {
         "==": soft_equals,
         "===": hard_equals,
-        "!=": lambda a, b: not soft_equals(a, b),
-        "!==": lambda a, b: not hard_equals(a, b),
-        ">": lambda a, b: less(b, a),
-        ">=": lambda a, b: less(b, a) or soft_equals(a, b),
+        "!=": not_soft_equals,
+        "!==": not_hard_equals,
+        ">": greater,
+        ">=": greater_or_equal,
         "<": less,
         "<=": less_or_equal,
-        "!": lambda a: not a,
+        "!": not_,
         "!!": bool,
-        "%": lambda a, b: a % b,
-        "and": lambda *args: functools.reduce(
-            lambda total, arg: total and arg, args, True
-        ),
-        "or": lambda *args: functools.reduce(
-            lambda total, arg: total or arg, args, False
-        ),
-        "?:": lambda a, b, c: b if a else c,
+        "%": modulo,
+        "and": and_,
+        "or": or_,
+        "?:": ternary,
         "if": if_,
-        "in": lambda a, b: a in b if "__contains__" in dir(b) else False,
-        "cat": lambda *args: "".join(str(arg) for arg in args),
+        "in": in_,
+        "cat": cat,
         "+": plus,
-        "*": lambda *args: functools.reduce(
-            lambda total, arg: total * float(arg), args, 1
-        ),
+        "*": times,
         "-": minus,
-        "/": lambda a, b=None: a if b is None else float(a) / float(b),
-        "min": lambda *args: min(args),
-        "max": lambda *args: max(args),
+        "/": divide,
+        "min": min_,
+        "max": max_,
         "merge": merge,
-        "count": lambda *args: sum(1 if a else 0 for a in args),
+        "count": count,
     }
 
     def apply(self, data):
         """Does the given data satisfy the expression?
         If the expression is empty, then trivially True.
         """
-        if self.expression:
-            return self._apply(self.expression, data)
-        else:
+        if self._function is None:
             return True
+        else:
+            return self._function(data or {})
 
-    def _apply(self, expression, data):
-        """Executes the json-logic with given data."""
-        # You've recursed to a primitive, stop!
-        if expression is None or not isinstance(expression, dict):
-            return expression
+    def _compile(self, expression):
+        """Compile the expression into a function of the data.
+        The expression is traversed only once, here, and not for every
+        data item, and the operations are looked up only once.
 
-        data = data or {}
+        Raises ValueError if an operation is not recognized.
+        """
+        # A primitive evaluates to itself.
+        if expression is None or not isinstance(expression, dict):
+            return lambda data: expression
 
-        operator = list(expression)[0]
+        operator = next(iter(expression))
         values = expression[operator]
 
+        # Fast path for the most common leaf, like {"var": "x"}.
+        if operator == "var" and isinstance(values, (str, int)):
+            return self.compile_var(values)
+
         # Easy syntax for unary operators, like {"var": "x"} instead of strict
         # {"var": ["x"]}
         if not isinstance(values, list) and not isinstance(values, tuple):
             values = [values]
 
         # Recursion!
-        values = [self._apply(val, data) for val in values]
+        functions = [self._compile(value) for value in values]
+
+        # Fast path for the unary negations; no list of values needed.
+        if operator == "!" and len(functions) == 1:
+            function = functions[0]
+            return lambda data: not function(data)
+        if operator == "!!" and len(functions) == 1:
+            function = functions[0]
+            return lambda data: bool(function(data))
 
         if operator == "var":
-            return self.get_var(data, *values)
-        if operator == "missing":
-            return self.missing(data, *values)
-        if operator == "missing_some":
-            return self.missing_some(data, *values)
+            operation = self.get_var
+        elif operator == "missing":
+            operation = self.missing
+        elif operator == "missing_some":
+            operation = self.missing_some
+        else:
+            try:
+                operation = self.operations[operator]
+            except KeyError:
+                raise ValueError("Unrecognized operation %s" % operator)
+            # Most operations are binary; call those with two locals,
+            # rather than building and unpacking a list of values.
+            if len(functions) == 2:
+                first, second = functions
+                return lambda data: operation(first(data), second(data))
+            return lambda data: operation(*[f(data) for f in functions])
+        # These operations need the data itself.
+        return lambda data: operation(data, *[f(data) for f in functions])
+
+    # The types of values as given by the SQLite function json_type.
+    sql_json_types = ("null", "true", "false", "integer", "real", "text", "array", "object")
+
+    sql_comparisons = {
+        "==": "=",
+        "===": "=",
+        "!=": "<>",
+        "!==": "<>",
+        "<": "<",
+        "<=": "<=",
+        ">": ">",
+        ">=": ">=",
+    }
 
-        try:
-            return self.operations[operator](*values)
-        except KeyError:
-            raise ValueError("Unrecognized operation %s" % operator)
+    # The operator to use when the operands of a comparison are swapped.
+    sql_swapped = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+    def to_sql(self, column):
+        """Translate the expression into an SQL expression for the given column
+        containing the JSON documents, using the SQLite JSON1 functions.
+
+        Handles 'and', 'or', '!' and comparisons of a 'var' with a literal
+        str, int or float. Returns a tuple (sql, params, exact), or None if
+        the expression cannot be translated. If 'exact' is False, the SQL
+        expression selects a superset of the documents satisfying the
+        expression, which must then be checked using 'apply'.
+        """
+        if not self.expression:
+            return ("1", [], True)
+        return self._to_sql(self.expression, column)
+
+    def _to_sql(self, expression, column):
+        "Translate the expression recursively; see 'to_sql'."
+        if not isinstance(expression, dict) or len(expression) != 1:
+            return None
+        operator = next(iter(expression))
+        values = expression[operator]
+        if not isinstance(values, list) and not isinstance(values, tuple):
+            values = [values]
+
+        if operator in ("and", "or"):
+            parts = [self._to_sql(value, column) for value in values]
+            exact = True
+            if operator == "and":
+                # Operands that cannot be translated are left for 'apply'.
+                if None in parts:
+                    exact = False
+                    parts = [part for part in parts if part is not None]
+            elif None in parts:
+                return None
+            if not parts:
+                return None
+            sql = f" {operator.upper()} ".join(f"({part[0]})" for part in parts)
+            params = [param for part in parts for param in part[1]]
+            return (sql, params, exact and all(part[2] for part in parts))
+
+        if operator == "!":
+            if len(values) != 1:
+                return None
+            part = self._to_sql(values[0], column)
+            if part is None or not part[2]:
+                return None
+            return (f"NOT ({part[0]})", part[1], True)
+
+        if operator not in self.sql_comparisons or len(values) != 2:
+            return None
+        path = self._sql_path(values[0])
+        literal = values[1]
+        if path is None:
+            path = self._sql_path(values[1])
+            literal = values[0]
+            operator = self.sql_swapped.get(operator, operator)
+        if path is None or type(literal) not in (str, int, float):
+            return None
+        # SQLite cannot bind an integer outside 64 bits.
+        if type(literal) is int and not -2**63 <= literal < 2**63:
+            return None
+
+        # The JSON value types for which the SQL comparison gives the
+        # same result as 'apply', and those for which the result is
+        # known to be true or false. Any other types, i.e. those that
+        # would need JS-style type coercion, are left for 'apply'.
+        numeric = not isinstance(literal, str)
+        if operator in ("===", "!=="):
+            exact = ({str: "text", int: "integer", float: "real"}[type(literal)],)
+            known = tuple(t for t in self.sql_json_types if t not in exact)
+        elif numeric:
+            exact = ("integer", "real")
+            known = ("null", "array", "object")
+        elif operator in ("==", "!="):
+            exact = ("integer", "text")
+            known = ()
+        else:
+            exact = ("text",)
+            known = ()
+        if operator in ("!=", "!=="):
+            true, false = known, ()
+        else:
+            true, false = (), known
+        rest = tuple(t for t in self.sql_json_types if t not in exact + known)
+
+        value = f"json_extract({column}, ?)"
+        if not numeric and operator in ("==", "!="):
+            value = f"CAST({value} AS TEXT)"
+        jsontype = f"IFNULL(json_type({column}, ?), 'null')"
+        clauses = [f"{jsontype} IN {self._sql_list(exact)}"
+                   f" AND {value} {self.sql_comparisons[operator]} ?"]
+        params = [path, path, literal]
+        for types in (true, rest):
+            if types:
+                clauses.append(f"{jsontype} IN {self._sql_list(types)}")
+                params.append(path)
+        return (" OR ".join(clauses), params, not rest)
+
+    @staticmethod
+    def _sql_path(expression):
+        """Return the JSON path for a 'var' expression with a simple keypath,
+        or None if it is not one.
+        """
+        if not isinstance(expression, dict) or list(expression) != ["var"]:
+            return None
+        var = expression["var"]
+        if isinstance(var, (list, tuple)):
+            if len(var) != 1:
+                return None
+            var = var[0]
+        if not isinstance(var, str) or not _KEYPATH_RX.fullmatch(var):
+            return None
+        return f"$.{var}"
+
+    @staticmethod
+    def _sql_list(items):
+        "Return the SQL list of the given constant strings."
+        return "(" + ", ".join(f"'{item}'" for item in items) + ")"
 
 
 class jsondocdbException(Exception):
@@ -1,50 +1,48 @@
 "Pytest functions for the module jsondocdb."
 
-import os
+import io
+import json
+import math
 import sqlite3
-import uuid
+import threading
 
 import pytest
 
 import jsondocdb
 
 
-def get_filepath():
-    base_filepath = "/tmp/test_jsondocdb"
-    count = 0
-    filepath = base_filepath + str(count)
-    while os.path.exists(filepath):
-        count += 1
-        filepath = base_filepath + str(count)
-    return filepath
+@pytest.fixture
+def filepath(tmp_path):
+    "Get the path for a database file in a temporary directory."
+    return str(tmp_path / "test.db")
 
 @pytest.fixture
 def db():
-    "Get a newly created database."
-    filepath = get_filepath()
-    db = jsondocdb.Database(filepath)
+    "Get a newly created in-memory database."
+    db = jsondocdb.Database(":memory:")
     yield db
     db.close()
-    os.remove(filepath)
+
+# Only read by the tests, never modified, so no copies are needed.
+_SEED_DOCS = [
+    ("first document", dict(a=1, b="two", c="III")),
+    ("second", dict(a=2, text="Some text.")),
+    ("third", dict(a=3, text="Another text.", d=True)),
+    ("fourth", dict(a=4, text="Some text.", d=False, x=[3, 2, "mix"])),
+    ("3f1c6a0e9b2d4e7fa5c8d1b0e6f2a9c4", dict(a=19, text="Further along.",
+                                              x={"lkla": 234,"q": [1,2]})),
+]
 
 def add_some_documents(db):
     with db:
-        db["first document"] = dict(a=1, b="two", c="III")
-        db["second"] = dict(a=2, text="Some text.")
-        db["third"] = dict(a=3, text="Another text.", d=True)
-        db["fourth"] = dict(a=4, text="Some text.", d=False, x=[3, 2, "mix"])
-        db[uuid.uuid4().hex] = dict(a=19, text="Further along.",
-                                    x={"lkla": 234,"q": [1,2]})
+        db.update_many(_SEED_DOCS)
 
-def test_create_db_file():
-    filepath = get_filepath()
+def test_create_db_file(filepath):
     db = jsondocdb.Database() 
     db.create(filepath)
     assert len(db) == 0, "The database should be empty."
-    os.remove(filepath)
 
-def test_create_close_reopen_db_file():
-    filepath = get_filepath()
+def test_create_close_reopen_db_file(filepath):
     db = jsondocdb.Database(filepath) 
     assert len(db) == 0, "The database should be empty."
     db.close()
@@ -53,10 +51,8 @@ def test_create_close_reopen_db_file():
     with pytest.raises(OSError):
         db3 = jsondocdb.Database()
         db3.create(filepath)
-    os.remove(filepath)
 
-def test_open_open_close_close():
-    filepath = get_filepath()
+def test_open_open_close_close(filepath):
     with pytest.raises(OSError):
         db = jsondocdb.Database()
         db.open(filepath)
@@ -67,10 +63,8 @@ def test_open_open_close_close():
     db.close()
     with pytest.raises(jsondocdb.ConnectionError):
         db.close()
-    os.remove(filepath)
 
-def test_create_close_reopen_readonly_db_file():
-    filepath = get_filepath()
+def test_create_close_reopen_readonly_db_file(filepath):
     with pytest.raises(OSError):
         db = jsondocdb.Database(filepath, readonly=True)
         db.open(filepath)
@@ -79,23 +73,72 @@ def test_create_close_reopen_readonly_db_file():
     db.close()
     db2 = jsondocdb.Database(filepath, readonly=True)
     assert len(db2) == 0, "The database should be empty."
-    os.remove(filepath)
+
+def test_pragmas(filepath):
+    db = jsondocdb.Database(filepath)
+    assert db.cnx.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.cnx.execute("PRAGMA synchronous").fetchone()[0] == 1, "NORMAL"
+    db.close()
+    db = jsondocdb.Database(filepath, pragmas=dict(synchronous="OFF", mmap_size=None))
+    assert db.cnx.execute("PRAGMA synchronous").fetchone()[0] == 0, "OFF"
+    db.close()
+    with pytest.raises(ValueError):
+        jsondocdb.Database(filepath, pragmas={"synchronous": "OFF; DROP TABLE documents"})
+    db = jsondocdb.Database(":memory:")
+    assert db.cnx.execute("PRAGMA journal_mode").fetchone()[0] == "memory"
 
 def test_not_a_sqlite_file():
     with pytest.raises(jsondocdb.InvalidFileError):
         db = jsondocdb.Database("test_jsondocdb.py")
 
-def test_sqlite_file_but_not_jsondocdb_file():
-    filepath = get_filepath()
+def test_bulk_load(filepath):
+    db = jsondocdb.Database(filepath)
+    synchronous = db.cnx.execute("PRAGMA synchronous").fetchone()[0]
+    with db.bulk_load():
+        assert db.cnx.execute("PRAGMA synchronous").fetchone()[0] == 0
+        add_some_documents(db)
+    assert db.cnx.execute("PRAGMA synchronous").fetchone()[0] == synchronous
+    assert len(db) == 5, "Documents loaded."
+    with db.bulk_load(pragmas={"optimize": 2}):
+        pass
+    with pytest.raises(ValueError):
+        with db.bulk_load(pragmas={"synchronous; DROP TABLE documents": 0}):
+            pass
+    with pytest.raises(ValueError):
+        with db.bulk_load(pragmas={"cache_size": "1; DROP TABLE documents"}):
+            pass
+    assert db.cnx.execute("PRAGMA synchronous").fetchone()[0] == synchronous, "Nothing applied."
+    with db:
+        with pytest.raises(jsondocdb.InTransactionError):
+            with db.bulk_load():
+                pass
+    db.close()
+
+def test_sqlite_file_but_not_jsondocdb_file(filepath):
     cnx = sqlite3.connect(filepath)
     cnx.execute("CREATE TABLE stuff (i INT PRIMARY KEY)")
     cnx.close()
     with pytest.raises(jsondocdb.InvalidFileError):
         db = jsondocdb.Database(filepath)
-    os.remove(filepath)
+
+def test_user_version(filepath):
+    db = jsondocdb.Database(filepath)
+    assert db.cnx.execute("PRAGMA user_version").fetchone()[0] != 0
+    db.close()
+    cnx = sqlite3.connect(filepath)
+    cnx.execute("PRAGMA user_version = 0")
+    cnx.close()
+    db = jsondocdb.Database(filepath)  # Older file; checked by its tables.
+    db.close()
+    cnx = sqlite3.connect(filepath)
+    cnx.execute("PRAGMA user_version = 42")
+    cnx.close()
+    with pytest.raises(jsondocdb.InvalidFileError):
+        db = jsondocdb.Database(filepath)
 
 def test_add_doc_retrieve(db):
     assert len(db) == 0, "Empty database."
+    assert not db, "Empty database is false."
     docid = "a document"
     doc = {"this": "is",
            "a": "document",
@@ -105,11 +148,22 @@ def test_add_doc_retrieve(db):
     with db:
         db[docid] = doc
     assert len(db) == 1, "One document in the database."
+    assert db, "Non-empty database is true."
     assert docid in db, "The identifier should be in the database."
     assert db[docid] == doc, "The identifier fetches its document."
     assert list(db.keys()) == [docid], "The list of identifiers in the database."
     assert list(db.values()) == [doc], "The list of documents in the database."
 
+def test_large_numbers(db):
+    doc = {"big": 10**20, "small": -2**63, "float": 1.5e300}
+    with db:
+        db["big"] = doc
+    assert db["big"] == doc, "Integers outside 64 bits are kept exactly."
+    assert type(db["big"]["big"]) is int, "A large integer stays an integer."
+    db.cnx.execute("INSERT INTO documents (identifier, document) VALUES (?, ?)",
+                   ("nan", json.dumps({"x": math.nan})))
+    assert math.isnan(db["nan"]["x"]), "NaN as written by 'json' can be read."
+
 def test_no_such_document(db):
     docid = "a document"
     doc = {"this": "is", "a": "document"}
@@ -117,8 +171,12 @@ def test_no_such_document(db):
         db[docid] = doc
     assert docid in db, "The identifier is in the database."
     assert "nonexistent" not in db, "The identifier is not in the database."
+    assert [1, 2] not in db, "Garbage identifier is not in the database."
     with pytest.raises(jsondocdb.NoSuchDocumentError):
         doc2 = db["nonexistent"]
+    assert db.get(docid) == doc, "The identifier fetches its document."
+    assert db.get("nonexistent") is None, "Default for missing document."
+    assert db.get("nonexistent", 1) == 1, "Explicit default for missing document."
 
 def test_transactions(db):
     with pytest.raises(jsondocdb.NotInTransactionError):
@@ -128,6 +186,58 @@ def test_transactions(db):
             with db:
                 pass
 
+def test_len(filepath):
+    db = jsondocdb.Database(filepath)
+    add_some_documents(db)
+    assert len(db) == 5, "Five documents."
+    with pytest.raises(ValueError):
+        with db:
+            db["another"] = dict(a=5)
+            assert len(db) == 6, "Six documents within the transaction."
+            raise ValueError
+    assert len(db) == 5, "Count restored after rollback."
+    other = jsondocdb.Database(filepath)
+    with other:
+        other["another"] = dict(a=5)
+    assert len(db) == 6, "Count updated after commit by another connection."
+    other.close()
+    db.close()
+
+def test_indexes_of_other_connection(filepath):
+    db = jsondocdb.Database(filepath)
+    add_some_documents(db)
+    other = jsondocdb.Database(filepath)
+    other.index("x", "a")
+    with db:
+        db["another"] = dict(a=5)
+    assert list(other.index("x").get(5)) == ["another"], "Index created by the other connection updated."
+    other.index("x").delete()
+    with db:
+        db["yet another"] = dict(a=6)
+    assert db.indexes() == [], "Index deleted by the other connection dropped."
+    other.close()
+    db.close()
+
+def test_transaction_other_connection(filepath):
+    db = jsondocdb.Database(filepath)
+    add_some_documents(db)
+
+    def write_other():
+        other = jsondocdb.Database(filepath)
+        with other:
+            other["other"] = dict(a=10)
+        other.close()
+
+    with db:
+        thread = threading.Thread(target=write_other)
+        thread.start()
+        # The other connection waits for this transaction to finish.
+        thread.join(0.5)
+        db["mine"] = dict(a=11)
+    thread.join()
+    assert "mine" in db and "other" in db, "Both transactions committed."
+    db.close()
+
 def test_add_doc_same_id(db):
     assert len(db) == 0, "Empty database."
     docid = "a document"
@@ -142,19 +252,18 @@ def test_add_doc_same_id(db):
     assert docid in db, "The identifier is in the database."
     assert list(db.keys()) == [docid], "The list of identifiers in the database."
 
+def test_keys_values_items_order(db):
+    add_some_documents(db)
+    assert list(zip(db.keys(), db.values())) == list(db.items()), "Same order."
+
 def test_several_docs(db):
     assert len(db) == 0, "Empty database."
+    pairs = [(f"myname{i}", dict(num=i, data="a string" * i)) for i in range(16)]
     with db:
-        for i in range(10):
-            docid = f"myname{i}"
-            doc = dict(num=i, data="a string" * i)
-            db[docid] = doc
+        db.update_many(pairs[:10])
     assert len(db) == 10, "Ten documents in the database."
     with db:
-        for i in range(5, 16):
-            docid = f"myname{i}"
-            doc = dict(num=i, data="a string" * i)
-            db[docid] = doc
+        db.update_many(pairs[5:])
     assert len(db) == 16, "Net sixteen documents in the database."
     for i in range(2,12):
         docid = f"myname{i}"
@@ -163,6 +272,42 @@ def test_several_docs(db):
         docid = f"myname{i}"
         assert docid not in db, "The identifier should not be in the database."
 
+def test_update_many_index(db):
+    add_some_documents(db)
+    x = db.index("my_index", "a", unique=True)
+    with db:
+        db.update_many({"second": dict(a=20), "new": dict(a=21)})
+    assert db["second"] == dict(a=20), "Document updated."
+    assert list(x.get(2)) == [], "Previous index entry removed."
+    assert list(x.get(20)) == ["second"], "Index entry updated."
+    assert list(x.get(21)) == ["new"], "Index entry added."
+    with pytest.raises(jsondocdb.NotUniqueError):
+        with db:
+            db.update_many([("other", dict(a=1))])
+    assert "other" not in db, "Transaction rolled back."
+    with pytest.raises(jsondocdb.NotInTransactionError):
+        db.update_many([("other", dict(a=100))])
+
+def test_delete_many(db):
+    add_some_documents(db)
+    x = db.index("my_index", "a")
+    with db:
+        db.attachments("second").put("a.txt", b"text")
+        db.delete_many(["first document", "second"])
+    assert len(db) == 3, "Two documents deleted."
+    assert "second" not in db, "Document deleted."
+    assert len(x) == len(db), "Index entries deleted."
+    assert db.info["n_attachments"] == 0, "Attachments deleted."
+    with db:
+        with pytest.raises(jsondocdb.NoSuchDocumentError):
+            db.delete_many(["third", "nonexistent"])
+        assert "third" not in db, "Existing document deleted anyway."
+    assert len(x) == len(db), "Index consistent with documents."
+    with db:
+        db.delete_many(["fourth", "fourth"])
+    assert "fourth" not in db, "Duplicated identifier deleted once."
+    assert len(db) == 1, "One document left."
+
 def test_create_delete_index(db):
     add_some_documents(db)
     x = db.index("my_index", "a", unique=True)
@@ -179,6 +324,13 @@ def test_create_delete_index(db):
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
     assert set([n[0] for n in cursor.fetchall()]) == set(["documents", "indexes", "attachments"]), "All index tables must have been deleted."
 
+def test_invalid_index_name(db):
+    add_some_documents(db)
+    for name in ["a-bad name!", "x; DROP TABLE documents", "1abc", "", None]:
+        with pytest.raises(jsondocdb.IndexSpecificationError):
+            db.index(name, "a")
+    assert len(db.indexes()) == 0, "No index should have been created."
+
 
 def test_index_get(db):
     add_some_documents(db)
@@ -204,6 +356,22 @@ def test_index_get(db):
         del db[identifier]
     assert len(x) == len(db), "Removing item from database should also remove entry from index."
     
+def test_index_maintained_after_reopen(filepath):
+    db = jsondocdb.Database(filepath)
+    add_some_documents(db)
+    db.index("my_index", "a")
+    db.close()
+    db = jsondocdb.Database(filepath)
+    assert [i.name for i in db.indexes()] == ["my_index"], "Index loaded on open."
+    with db:
+        db["new"] = dict(a=100)
+    assert list(db.index("my_index").get(100)) == ["new"], "Index updated after reopen."
+    with db:
+        db["new"] = dict(a=101)
+    assert list(db.index("my_index").get(100)) == [], "Previous entry removed."
+    assert list(db.index("my_index").get(101)) == ["new"], "Index updated."
+    db.close()
+
 def test_index_get_unique(db):
     add_some_documents(db)
     x = db.index("index", "a", unique=True)
@@ -212,6 +380,52 @@ def test_index_get_unique(db):
     with pytest.raises(jsondocdb.NotUniqueError):
         y = db.index("unique_index", "text", unique=True)
 
+def test_index_invalid_key(db):
+    add_some_documents(db)
+    with pytest.raises(ValueError):
+        db.index("x_index", "x")
+    assert len(db.indexes()) == 0, "The index should not have been created."
+    y = db.index("y_index", "x.q")
+    assert sorted(key for i, key in y.range()) == [1, 2], "List of keys indexed."
+    with db:
+        with pytest.raises(ValueError):
+            db["bad"] = dict(x=dict(q=dict(r=1)))
+
+def test_index_built_in_sql(db):
+    "Indexes built by SQLite must equal those built from the documents."
+    with db:
+        db["a"] = dict(k="x", n=dict(m=[1, 2.5, "z"]), b=True)
+        db["b"] = dict(k=None, n=dict(m=[]), b=False)
+        db["c"] = dict(k=3, n=dict(m="w"))
+        db["d"] = dict(k=[], n=[1])
+    for keypath in ["k", "n.m", "b"]:
+        sql = db.index("sql_index", keypath)
+        python = db.index("python_index", keypath, require={"!!": 1})
+        assert sorted(sql.range(), key=str) == sorted(python.range(), key=str)
+        sql.delete()
+        python.delete()
+    with db:
+        db["e"] = dict(k="x")
+    with pytest.raises(jsondocdb.NotUniqueError):
+        db.index("unique_index", "k", unique=True)
+    with db:
+        db["f"] = dict(k=[1, None])
+    with pytest.raises(ValueError):
+        db.index("bad_index", "k")
+    assert len(db.indexes()) == 0, "No index should have been created."
+
+def test_index_nan_without_orjson(db, monkeypatch):
+    monkeypatch.setattr(jsondocdb, "orjson", None)
+    with db:
+        db["a"] = {"k": 1, "x": math.nan, "y": [math.inf]}
+        db["b"] = {"k": 2, "n": 10**20}
+    assert db["a"] == {"k": 1, "x": None, "y": [None]}, "NaN and Infinity stored as null."
+    assert list(db.index("kx", "k").get(1)) == ["a"], "Index built by SQLite."
+    # Text with NaN, as written by earlier versions.
+    db.cnx.execute("INSERT INTO documents (identifier, document) VALUES (?, ?)",
+                   ("c", json.dumps({"k": 3, "x": math.nan})))
+    assert list(db.index("ky", "k").get(3)) == ["c"], "Index built from the documents."
+
 def test_index_range(db):
     add_some_documents(db)
     x = db.index("my_index", "a")
@@ -249,27 +463,207 @@ def test_attachment(db):
     assert docid in db, "Document in database."
     a = db.attachments(docid)
     assert len(a) == 0, "Initially no attachments for the document."
+    assert not a, "No attachments is false."
     filepath = "test_jsondocdb.py"
     with open(filepath, "rb") as infile:
         content = infile.read()
     length = len(content)
     with db:
-        a.put(filepath, content)
+        a.put_file(filepath, filepath)
     assert len(a) == 1, "One attachment for the document."
+    assert a, "Attachments is true."
     b = db.attachments(docid)
     assert len(b) == 1, "One attachment for the document."
     att = b.get(filepath)
     assert att.name == filepath, "Attachment name is the filepath."
     assert att.content_type == "text/x-python", "Python content type."
     assert len(att) == length, "Correct length."
+    assert att.content == content, "Content streamed from the file."
     faked_filepath = "tmp.txt"
     with db:
         b.put(faked_filepath, content=b"some text")
     assert len(b) == 2, "Two attachments for the document."
+    with pytest.raises(ValueError):
+        with db:
+            b.put_stream(faked_filepath, io.BytesIO(b"short"), 10)
+    assert b.get(faked_filepath).content == b"some text", "Update rolled back."
     assert set(b.keys()) == set([filepath, faked_filepath])
     with db:
         b.get(faked_filepath).delete()
     assert len(b) == 1, "One attachment for the document."
     with db:
+        b.put_file("READMEX", filepath)
+        b.put("LICENSEX", b"text")
+    assert b.get("READMEX").content == content, "Content without extension."
+    assert b.get("READMEX").content_type == "application/octet-stream"
+    assert b.get("LICENSEX").content_type == "application/octet-stream"
+    with db:
+        b.put_file("READMEX", filepath)
+        del b["READMEX"]
+        del b["LICENSEX"]
         del b[filepath]
     assert len(b) == 0, "No attachments for the document."
+
+def test_attachments_identifier_lookup_uses_index(db):
+    for sql in ["SELECT COUNT(*) FROM attachments WHERE identifier=?",
+                "DELETE FROM attachments WHERE identifier=?"]:
+        cursor = db.cnx.execute(f"EXPLAIN QUERY PLAN {sql}", ("x",))
+        plan = " ".join(row[-1] for row in cursor)
+        assert "attachments_index" in plan, "Lookup by identifier must not scan the table."
+
+def test_index_identifier_lookup_uses_index(db):
+    add_some_documents(db)
+    db.index("my_index", "a")
+    cursor = db.cnx.execute("EXPLAIN QUERY PLAN DELETE FROM i_my_index WHERE identifier=?", ("x",))
+    plan = " ".join(row[-1] for row in cursor)
+    assert "xi_my_index" in plan, "Delete by identifier must not scan the index table."
+
+def test_jsonlogic_arithmetic():
+    data = dict(a=2, b="3", c="1.5")
+    assert jsondocdb.JsonLogic({"+": [{"var": "a"}, {"var": "b"}]}).apply(data) == 5
+    assert jsondocdb.JsonLogic({"+": [{"var": "a"}, {"var": "c"}]}).apply(data) == 3.5
+    assert jsondocdb.JsonLogic({"-": [{"var": "b"}, {"var": "a"}]}).apply(data) == 1
+    assert jsondocdb.JsonLogic({"-": "4"}).apply(data) == -4
+
+def test_jsonlogic_comparison():
+    data = dict(a=2, b="3")
+    assert jsondocdb.JsonLogic({"<": [1, {"var": "a"}, {"var": "b"}]}).apply(data)
+    assert not jsondocdb.JsonLogic({"<": [1, {"var": "b"}, {"var": "a"}]}).apply(data)
+    assert jsondocdb.JsonLogic({"<=": [1, 2, 2, 3]}).apply(data)
+    assert not jsondocdb.JsonLogic({"<=": [1, 3, 2]}).apply(data)
+    assert not jsondocdb.JsonLogic({"<": [1, "x"]}).apply(data)
+    assert jsondocdb.JsonLogic({">": [{"var": "b"}, {"var": "a"}]}).apply(data)
+    assert jsondocdb.JsonLogic({">=": [{"var": "a"}, 2]}).apply(data)
+
+def test_find(db):
+    add_some_documents(db)
+    with db:
+        db["coerced"] = dict(a="2", d=1, text=5)
+        db["nested"] = dict(a=[2], b={"c": 3}, d=None)
+    for expression in [{},
+                       {"==": [{"var": "a"}, 2]},
+                       {"==": [2, {"var": "a"}]},
+                       {"===": [{"var": "a"}, 2]},
+                       {"!==": [{"var": "a"}, 2]},
+                       {"!=": [{"var": "a"}, 2]},
+                       {"==": [{"var": "text"}, "Some text."]},
+                       {"!=": [{"var": "text"}, "5"]},
+                       {"<": [{"var": "a"}, 3]},
+                       {">=": [3, {"var": "a"}]},
+                       {"==": [{"var": "b.c"}, 3]},
+                       {"and": [{">": [{"var": "a"}, 1]}, {"var": "d"}]},
+                       {"or": [{"<": [{"var": "a"}, 2]}, {">": [{"var": "a"}, 3]}]},
+                       {"!": {"===": [{"var": "a"}, 1]}},
+                       {"!": {"var": "d"}},
+                       {"<": [{"var": "a"}, 10**20]}]:
+        logic = jsondocdb.JsonLogic(expression)
+        expected = set(i for i, doc in db.items() if logic.apply(doc))
+        assert set(i for i, doc in db.find(expression)) == expected, expression
+
+def test_find_nan(db, monkeypatch):
+    monkeypatch.setattr(jsondocdb, "orjson", None)
+    with db:
+        db["a"] = dict(a=1, x=math.nan)
+    # Text with NaN, as written by earlier versions.
+    db.cnx.execute("INSERT INTO documents (identifier, document) VALUES (?, ?)",
+                   ("b", json.dumps(dict(a=2, x=math.nan))))
+    with db:
+        db["c"] = dict(a=3)
+    assert [i for i, doc in db.find({">": [{"var": "a"}, 1]})] == ["b", "c"]
+    assert [i for i, doc in db.find({"==": [{"var": "a"}, 1]})] == ["a"]
+
+def test_raw_documents(db):
+    add_some_documents(db)
+    raw = db.get_raw("second")
+    assert isinstance(raw, bytes), "Raw document is bytes."
+    assert json.loads(raw) == db["second"], "Raw document is the JSON text."
+    with db:
+        db.put_raw("raw", b'{"a": 5, "text": "r\xc3\xa5"}')
+        db.put_raw("second", '{"a": 6}')
+    assert db["raw"] == {"a": 5, "text": "rå"}, "Raw bytes stored as JSON text."
+    assert db["second"] == {"a": 6}, "Raw str updates the document."
+    with db:
+        with pytest.raises(ValueError):
+            db.put_raw("bad", b"{not json")
+        with pytest.raises(ValueError):
+            db.put_raw("bad", b"[1, 2]")
+    assert "bad" not in db
+    x = db.index("my_index", "a")
+    with db:
+        db.put_raw("indexed", b'{"a": 7}')
+        with pytest.raises(ValueError):
+            db.put_raw("bad", b"[1, 2]")
+        with pytest.raises(ValueError):
+            db.put_raw("bad", b"{not json")
+    assert list(x.get(7)) == ["indexed"], "Raw document added to index."
+    x.delete()
+    with db:
+        with pytest.raises(ValueError):
+            db.put_raw("bad", "{a: 1}")     # JSON5, accepted by newer SQLite.
+        with pytest.raises(ValueError):
+            db.put_raw("bad", '{"a": NaN}')
+        with pytest.raises(ValueError):
+            db.put_raw("bad", b'{"a": -Infinity, "n": 100000000000000000000}')
+
+def test_jsonlogic_and_or():
+    for expression, result in [({"and": [1, "a", 0, 2]}, 0),
+                               ({"and": [1, "a"]}, "a"),
+                               ({"and": []}, True),
+                               ({"or": [0, "", "b", 3]}, "b"),
+                               ({"or": [0, ""]}, ""),
+                               ({"or": []}, False),
+                               ({"*": [2, "3", 1.5]}, 9.0),
+                               ({"count": [1, 0, "x", ""]}, 2)]:
+        assert jsondocdb.JsonLogic(expression).apply({}) == result, expression
+
+def test_jsonlogic_missing_and_invalid(db):
+    data = dict(a=1, b=dict(c=2))
+    assert jsondocdb.JsonLogic({"missing": ["a", "b.c", "x"]}).apply(data) == ["x"]
+    assert jsondocdb.JsonLogic({"missing_some": [1, ["a", "x"]]}).apply(data) == []
+    assert jsondocdb.JsonLogic({"if": [{"var": "b.c"}, "yes", "no"]}).apply(data) == "yes"
+    with pytest.raises(ValueError):
+        jsondocdb.JsonLogic({"nonsense": [1, 2]})
+    with pytest.raises(jsondocdb.IndexSpecificationError):
+        db.index("my_index", "a", require={"nonsense": [1, 2]})
+
+def test_jsonlogic_var():
+    data = dict(a=1, b=dict(c=[10, 20, dict(d="x")]), s="str")
+    for keypath, result in [("a", 1), ("b.c.1", 20), ("b.c.2.d", "x"),
+                            ("b.c.-1.d", "x"), ("b.c.5", None), ("b.x", None),
+                            ("a.b", None), ("s.x", None), ("nothing", None)]:
+        assert jsondocdb.JsonLogic({"var": keypath}).apply(data) == result, keypath
+        assert jsondocdb.JsonLogic({"var": [keypath]}).apply(data) == result, keypath
+
+def test_document_cache(db):
+    add_some_documents(db)
+    db.set_cache_size(2)
+    assert db["second"] is db["second"], "Document from cache."
+    db["third"]
+    db["fourth"]
+    assert list(db._cache) == ["third", "fourth"], "Least recently used evicted."
+    with db:
+        db["third"] = dict(a=30)
+    assert db["third"] == dict(a=30), "Cache invalidated by update."
+    with pytest.raises(ValueError):
+        with db:
+            db["fourth"] = dict(a=40)
+            assert db["fourth"] == dict(a=40)
+            raise ValueError
+    assert db["fourth"]["a"] == 4, "Cache cleared on rollback."
+    with db:
+        del db["fourth"]
+    assert "fourth" not in db._cache, "Cache invalidated by delete."
+    db.set_cache_size(0)
+    assert db["second"] is not db["second"], "No caching."
+
+def test_document_cache_other_connection(filepath):
+    db = jsondocdb.Database(filepath)
+    add_some_documents(db)
+    db.set_cache_size(10)
+    assert db["second"]["a"] == 2
+    other = jsondocdb.Database(filepath)
+    with other:
+        other["second"] = dict(a=20)
+    assert db["second"] == dict(a=20), "Cache cleared after other connection's change."
+    other.close()
+    db.close()
@@ -1,8 +1,7 @@
 "Test undumping a substantial Anubis dump into jsondocdb."
 
-import json
+import itertools
 import os.path
-import random
 import tarfile
 import time
 
@@ -10,36 +9,48 @@ import jsondocdb
 
 import tqdm
 
+# The number of archive members loaded in each transaction.
+BATCH = 1000
+
+
+def load_json(infile):
+    """Decode the JSON document read from the binary file-like object.
+    Done as by jsondocdb, which uses orjson if available, but keeps
+    integers outside its 64-bit range exact.
+    """
+    return jsondocdb._jsondoc_loads(infile.read())
+
+# The indexes to create for each doctype: tuples of (name, keypath).
+INDEXES = {
+    "call": [("call_identifier", "identifier"),
+             ("call_closes", "closes"),
+             ("call_opens", "opens"),
+             ("call_owner", "owner")],
+    "proposal": [("proposal_identifier", "identifier"),
+                 ("proposal_call", "call"),
+                 ("proposal_user", "user")],
+    "review": [("review_call", "call"),
+               ("review_proposal", "proposal"),
+               ("review_reviewer", "reviewer")],
+    "decision": [("decision_call", "call"),
+                 ("decision_proposal", "proposal")],
+    "grant": [("grant_identifier", "identifier"),
+              ("grant_call", "call"),
+              ("grant_proposal", "proposal"),
+              ("grant_user", "user")],
+    "user": [("user_username", "username"),
+             ("user_email", "email"),
+             ("user_orcid", "orcid"),
+             ("user_role", "role"),
+             ("user_status", "status"),
+             ("user_last_login", "last_login")],
+}
 
 def create_indexes(db):
-    require_call = {"==": [{"var": "doctype"}, "call"]}
-    db.index("call_identifier", "identifier", require=require_call)
-    db.index("call_closes", "closes", require=require_call)
-    db.index("call_opens", "opens", require=require_call)
-    db.index("call_owner", "owner", require=require_call)
-    require_proposal = {"==": [{"var": "doctype"}, "proposal"]}
-    db.index("proposal_identifier", "identifier", require=require_proposal)
-    db.index("proposal_call", "call", require=require_proposal)
-    db.index("proposal_user", "user", require=require_proposal)
-    require_review = {"==": [{"var": "doctype"}, "review"]}
-    db.index("review_call", "call", require=require_review)
-    db.index("review_proposal", "proposal", require=require_review)
-    db.index("review_reviewer", "reviewer", require=require_review)
-    require_decision = {"==": [{"var": "doctype"}, "decision"]}
-    db.index("decision_call", "call", require=require_decision)
-    db.index("decision_proposal", "proposal", require=require_decision)
-    require_grant = {"==": [{"var": "doctype"}, "grant"]}
-    db.index("grant_identifier", "identifier", require=require_grant)
-    db.index("grant_call", "call", require=require_grant)
-    db.index("grant_proposal", "proposal", require=require_grant)
-    db.index("grant_user", "user", require=require_grant)
-    require_user = {"==": [{"var": "doctype"}, "user"]}
-    db.index("user_username", "username", require=require_user)
-    db.index("user_email", "email", require=require_user)
-    db.index("user_orcid", "orcid", require=require_user)
-    db.index("user_role", "role", require=require_user)
-    db.index("user_status", "status", require=require_user)
-    db.index("user_last_login", "last_login", require=require_user)
+    for doctype, indexes in INDEXES.items():
+        require = {"==": [{"var": "doctype"}, doctype]}
+        for name, keypath in indexes:
+            db.index(name, keypath, require=require)
 
 def undump(filepath, db):
     """Load the `tar` file given by the path into the database.
@@ -51,42 +62,74 @@ def undump(filepath, db):
     NOTE: The documents are just added to the database, ignoring any
     `_rev` items. This means that no document with the same identifier
     must exist in the database.
+
+    The database must not have any indexes; create them afterwards,
+    which builds each one in a single pass instead of entry by entry.
+    The load is done in the bulk load mode of the database.
+
+    Raises ValueError if the database has any indexes.
+    Raises jsondocdb.InTransactionError
     """
+    if db.indexes():
+        raise ValueError("Create the indexes after undumping, not before.")
     ndocs = 0
     nfiles = 0
-    atts = dict()
-    with tarfile.open(filepath, mode="r") as infile:
-        total = sum(1 for member in infile if member.isreg())
-    with tarfile.open(filepath, mode="r") as infile:
-        iterator = tqdm.tqdm(infile, total=total)
-        for item in iterator:
-            itemfile = infile.extractfile(item)
-            itemdata = itemfile.read()
-            itemfile.close()
-            if item.name in atts:
-                # An attachment follows its document.
-                a = atts.pop(item.name)
-                with db:
-                    db.attachments(doc["_id"]).put(a["filename"], itemdata, a["content_type"])
-                nfiles += 1
-            else:
-                doc = json.loads(itemdata.decode("utf-8"))
-                doc.pop("_rev", None)
-                atts = doc.pop("_attachments", dict())
+    # Attachments still expected from the archive, keyed by member name:
+    # tuples (identifier of their document, filename, content type).
+    # The identifier is kept, since later documents may come in between.
+    pending_atts = dict()
+    # Durability is traded for speed during the load.
+    with db.bulk_load():
+        # A single pass; the archive is not read in advance just to count
+        # the members for the progress bar.
+        with open(filepath, "rb") as rawfile, tarfile.open(fileobj=rawfile, mode="r") as infile:
+            # The archive is read strictly in order; let the OS read ahead more.
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(rawfile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            items = iter(tqdm.tqdm(infile, unit="file", mininterval=0.5, miniters=256))
+            # One transaction per batch of members, rather than per member.
+            count = BATCH
+            while count == BATCH:
+                count = 0
+                docs = []  # Written by one call, unless an attachment intervenes.
                 with db:
-                    db[doc["_id"]] = doc
-                ndocs += 1
-                for attname, attinfo in list(atts.items()):
-                    key = u"{}_att/{}".format(doc["_id"], attname)
-                    atts[key] = dict(filename=attname,
-                                     content_type=attinfo["content_type"])
+                    for item in itertools.islice(items, BATCH):
+                        count += 1
+                        if not item.isreg():
+                            continue
+                        itemfile = infile.extractfile(item)
+                        if item.name in pending_atts:
+                            # An attachment follows its document, which must
+                            # be written before it.
+                            if docs:
+                                db.update_many(docs)
+                                docs.clear()
+                            doc_id, filename, content_type = pending_atts.pop(item.name)
+                            # Streamed, without reading the whole content into memory.
+                            db.attachments(doc_id).put_stream(filename, itemfile, item.size, content_type)
+                            itemfile.close()
+                            nfiles += 1
+                        else:
+                            doc = load_json(itemfile)
+                            itemfile.close()
+                            doc.pop("_rev", None)
+                            doc_atts = doc.pop("_attachments", dict())
+                            doc_id = doc["_id"]
+                            docs.append((doc_id, doc))
+                            ndocs += 1
+                            pending_atts.update(
+                                (f"{doc_id}_att/{attname}", (doc_id, attname, attinfo["content_type"]))
+                                for attname, attinfo in doc_atts.items()
+                            )
+                    if docs:
+                        db.update_many(docs)
     return (ndocs, nfiles)
 
 
 if __name__ == "__main__":
     dbfilepath = "dump.db"
     db = jsondocdb.Database(dbfilepath)
-    if len(db) == 0:
+    if not db:
         time0 = time.perf_counter()
         print(undump("anubis_dump_2023-01-17.tar.gz", db))
         print(time.perf_counter() - time0, "seconds")
@@ -94,9 +137,11 @@ if __name__ == "__main__":
         create_indexes(db)
         print(time.perf_counter() - time0, "seconds")
     print(db)
-    identifiers = list(db)
+    # The sample is drawn by SQLite, without a list of all identifiers.
+    sql = "SELECT identifier FROM documents ORDER BY RANDOM() LIMIT 10000"
+    identifiers = [row[0] for row in db.cnx.execute(sql)]
     time0 = time.perf_counter()
-    for identifier in random.sample(identifiers, 10000):
+    for identifier in identifiers:
         doc = db[identifier]
         a = db.attachments(identifier)
         if a: